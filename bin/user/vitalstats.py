@@ -30,10 +30,15 @@ requires python 3.x, psutil module
 vitalstats: ©2020 Graham Eddy <graham.eddy@gmail.com>
 weewx: Copyright (c) 2020 Tom Keffer <tkeffer@gmail.com>
 """
+import atexit
+import glob
 import logging
 import os
 import psutil
-from dataclasses import dataclass
+import threading
+import time
+from enum import IntEnum
+from typing import Callable, NamedTuple
 
 import weewx
 import weewx.units
@@ -54,75 +59,209 @@ weewx.units.obs_group_dict['mem_avail'] = 'group_data'
 weewx.units.obs_group_dict['disk_avail'] = 'group_data'
 
 
-@dataclass
-class Algorithm:
+class _Obs(IntEnum):
+    """index of each stat, whose obs_type is its name in lower case"""
+    CPU_LOAD = 0
+    CPU_IDLE = 1
+    CPU_TEMP = 2
+    MEM_AVAIL = 3
+    DISK_AVAIL = 4
+
+
+class Algorithm(NamedTuple):
     """define how to calculate stat"""
     #input_unit:    str             # no input
-    get_stat:       [[], float]     # calculation
+    get_stat:       Callable[[], float] # calculation
     output_unit:    str             # output unit of measure
     output_group:   str             # output unit group
+    refresh_period: float = 0.0     # secs to reuse previous value
+
+
+def _open_stat_fd(path):
+    """open kernel stats file for repeated positional reads, or None"""
+    try:
+        return os.open(path, os.O_RDONLY)
+    except OSError:
+        return None
+
+
+# kernel stats files are held open and re-read from the start on each call
+# by a single pread, saving the open/close and seek per stat. None means not
+# available on this host, so fall back to psutil
+_stat_fd = _open_stat_fd('/proc/stat')
+_meminfo_fd = _open_stat_fd('/proc/meminfo')
+_loadavg_fd = _open_stat_fd('/proc/loadavg')
+
+
+def _open_thermal_fd(sensor):
+    """open temp file of first thermal zone psutil names sensor, or None"""
+    for zone in sorted(glob.glob('/sys/class/thermal/thermal_zone*')):
+        try:
+            with open(os.path.join(zone, 'type')) as f:
+                # psutil's name is the zone's hwmon name, for which the
+                # kernel replaces '-' in zone type (e.g. 'cpu-thermal')
+                if f.read().strip().replace('-', '_') == sensor:
+                    return _open_stat_fd(os.path.join(zone, 'temp'))
+        except OSError:
+            pass
+    return None
+
+
+# zone psutil would report as 'cpu_thermal', found once rather than
+# psutil scanning every hwmon and thermal zone on each call
+_thermal_fd = _open_thermal_fd('cpu_thermal')
+
+
+@atexit.register
+def _close_stat_files():
+    """close kernel stats files held open"""
+    for fd in (_stat_fd, _meminfo_fd, _loadavg_fd, _thermal_fd):
+        if fd is not None:
+            os.close(fd)
+
+
+if _loadavg_fd is not None:
+    def cpu_load_5m():
+        """calculate 5min load (runq length) across all cpus"""
+        # 'load1 load5 load15 ...', updated by kernel every 5s
+        return float(os.pread(_loadavg_fd, 64, 0).split(None, 2)[1])
+else:
+    def cpu_load_5m():
+        """calculate 5min load (runq length) across all cpus"""
+        return os.getloadavg()[1] #/psutil.cpu_count() # no longer per-cpu
+
+
+if _thermal_fd is not None:
+    def cpu_temp():
+        """calculate cpu core temperature in celsius"""
+        return int(os.pread(_thermal_fd, 16, 0))/1000.0    # millidegrees
+else:
+    def cpu_temp():
+        """calculate cpu core temperature in celsius"""
+        return psutil.sensors_temperatures()['cpu_thermal'][0][1]
+
+
+# linux provides the few fields wanted directly from kernel stats files,
+# cheaper than psutil building every field. otherwise, psutil it is
+if _stat_fd is not None:
+    def cpu_idle():
+        """calculate cpu idle time (exclude system or user) as percentage"""
+        # first line is aggregate 'cpu user nice system idle ...' in ticks
+        fields = os.pread(_stat_fd, 256, 0).split(None, 5)
+        user, system, idle = int(fields[1]), int(fields[3]), int(fields[4])
+        return idle*100.0/(user + system + idle)
+else:
+    def cpu_idle():
+        """calculate cpu idle time (exclude system or user) as percentage"""
+        ratios = psutil.cpu_times()
+        return ratios[3]/(ratios[0] + ratios[2] + ratios[3])*100.0
+
+
+if (_meminfo_fd is not None
+        and b'MemAvailable:' in os.pread(_meminfo_fd, 256, 0)):
+    def mem_avail():
+        """calculate available physical memory as bytes"""
+        # early line 'MemAvailable:   <n> kB'
+        data = os.pread(_meminfo_fd, 256, 0)
+        i = data.index(b'MemAvailable:') + 13
+        return int(data[i:data.index(b'kB', i)])*1024
+else:
+    # no file, or kernel too old to provide MemAvailable
+    def mem_avail():
+        """calculate available physical memory as bytes"""
+        return psutil.virtual_memory()[1]
+
+
+_disk_frsize = os.statvfs('/').f_frsize    # fragment size fixed for mount
 
 
-def cpu_load_5m():
-    """calculate 5min load (runq length) across all cpus"""
-    return os.getloadavg()[1] #/psutil.cpu_count() # no longer per-cpu
+def disk_avail():
+    """calculate available disk space as bytes"""
+    # as psutil.disk_usage('/').free, without the rest of its namedtuple
+    return os.statvfs('/').f_bavail*_disk_frsize
 
 
-def cpu_temp():
-    """calculate cpu core temperature in celsius"""
-    return psutil.sensors_temperatures()['cpu_thermal'][0][1]
+class _Collector:
+    """evaluate stats on behalf of every consumer, sharing each value until
+    its refresh_period has passed so slowly changing stats are re-evaluated
+    no more often than they change"""
 
+    TICK = 0.5      # secs within which any value is shared regardless
+    SLACK = 0.5     # secs early a value may go stale, half POLL_PERIOD so
+                    # polls at multiples of refresh_period re-read it
 
-def cpu_idle():
-    """calculate cpu idle time (exclude system or user) as percentage"""
-    ratios = psutil.cpu_times()
-    return ratios[3]/(ratios[0] + ratios[2] + ratios[3])*100.0
+    def __init__(self):
+        self._cache = [None]*len(_Obs)  # by _Obs: (monotonic time, value)
+        self._lock = threading.Lock()
 
+    def get(self, obs, get_stat, refresh_period):
+        """return value of stat, evaluating it afresh only if stale"""
+        with self._lock:
+            now = time.monotonic()
+            cached = self._cache[obs]
+            if (cached is None
+                    or now - cached[0] >= max(refresh_period - _Collector.SLACK,
+                                              _Collector.TICK)):
+                cached = self._cache[obs] = (now, get_stat())
+            return cached[1]
 
-def mem_avail():
-    """calculate available physical memory as bytes"""
-    return psutil.virtual_memory()[1]
+    def clear(self):
+        """forget all values"""
+        with self._lock:
+            self._cache = [None]*len(_Obs)
 
 
-def disk_avail():
-    """calculate available disk space as bytes"""
-    return psutil.disk_usage('/')[2]
+_collector = _Collector()
 
 
 class VitalStatsSvc(StdService):
     """weewx data service to provide VitalStats observations"""
 
     DEF_BINDINGS = ['archive']
-
-    STATS = {
-        'cpu_load' : Algorithm(get_stat=cpu_load_5m,
-                               output_unit='count',
-                               output_group='group_count'),
-        'cpu_idle' : Algorithm(get_stat=cpu_idle,
-                               output_unit='percent',
-                               output_group='group_percent'),
-        'cpu_temp' : Algorithm(get_stat=cpu_temp,
-                               output_unit='degree_C',
-                               output_group='group_temperature'),
-        'mem_avail': Algorithm(get_stat=mem_avail,
-                               output_unit='byte',
-                               output_group='group_data'),
-        'disk_avail': Algorithm(get_stat=disk_avail,
-                                output_unit='byte',
-                                output_group='group_data'),
-    }
+    POLL_PERIOD = 1.0           # secs between background collections
+
+    STATS = [   # indexed by _Obs
+        Algorithm(get_stat=cpu_load_5m,
+                  output_unit='count',
+                  output_group='group_count',
+                  refresh_period=5.0),
+        Algorithm(get_stat=cpu_idle,
+                  output_unit='percent',
+                  output_group='group_percent',
+                  refresh_period=0.0),
+        Algorithm(get_stat=cpu_temp,
+                  output_unit='degree_C',
+                  output_group='group_temperature',
+                  refresh_period=10.0),
+        Algorithm(get_stat=mem_avail,
+                  output_unit='byte',
+                  output_group='group_data',
+                  refresh_period=1.0),
+        Algorithm(get_stat=disk_avail,
+                  output_unit='byte',
+                  output_group='group_data',
+                  refresh_period=30.0),
+    ]
 
     def __init__(self, engine, config_dict):
         super(VitalStatsSvc, self).__init__(engine, config_dict)
+        self._cn = type(self).__name__     # for log messages
 
         if weewx.debug > 0:
-            log.debug(f"{self.__class__.__name__} {version} starting")
+            log.debug("%s %s starting", self._cn, version)
+
+        # latest raw value of each LOOP stat by _Obs, replaced whole by poller
+        self._latest = [None]*len(_Obs)
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._failures = dict()     # last error of each failing stat by _Obs
 
         # configuration
         svc_sect = config_dict.get('VitalStats', {})
-        self.loop_stats = list()    # list of stats for each LOOP packet
-        self.archive_stats = list() # list of stats for each ARCHIVE record
-        for obs_type in VitalStatsSvc.STATS:
+        self.loop_stats = list()    # list of _Obs for each LOOP packet
+        self.archive_stats = list() # list of _Obs for each ARCHIVE record
+        for obs in _Obs:
+            obs_type = obs.name.lower()
 
             # determine bindings for known obs_type
             if obs_type in svc_sect:
@@ -138,65 +277,185 @@ class VitalStatsSvc(StdService):
 
             # add to appropriate loop_ or archive_ lists
             if 'loop' in bindings:
-                self.loop_stats.append(obs_type)
+                self.loop_stats.append(obs)
             if 'archive' in bindings:
-                self.archive_stats.append(obs_type)
+                self.archive_stats.append(obs)
+
+        self.loop_stats = tuple(self.loop_stats)
+        self.archive_stats = tuple(self.archive_stats)
+
+        # precompute what augment_packet needs of each stat, and
+        # specialise it to each plan for when not debugging
+        self._loop_plan = self.make_plan(self.loop_stats)
+        self._archive_plan = self.make_plan(self.archive_stats)
+        self._loop_augmenter = self.make_augmenter(self._loop_plan)
+        self._archive_augmenter = self.make_augmenter(self._archive_plan)
 
         # do we have any work to do?
         if weewx.debug > 1:
-            log.debug(f"{self.__class__.__name__} loop_stats={self.loop_stats}"
-                      f" archive_stats={self.archive_stats}")
+            log.debug("%s loop_stats=%s archive_stats=%s", self._cn,
+                      [o.name.lower() for o in self.loop_stats],
+                      [o.name.lower() for o in self.archive_stats])
         if len(self.loop_stats) <= 0 and len(self.archive_stats) <= 0:
-            log.warning(f"{self.__class__.__name__} no stat bindings - exit")
+            log.warning("%s no stat bindings - exit", self._cn)
             return      # slip away without binding to any packets
 
-        # bind to LOOP if required
+        # bind to LOOP if required. LOOP stats are collected once up front
+        # so first packets are not missing them, then kept collected in
+        # background off the event dispatch path
         if len(self.loop_stats) > 0:
+            self._latest = self.collect(self._loop_plan)
+            self._thread = threading.Thread(target=self.poll_loop,
+                                            name='VitalStats', daemon=True)
+            self._thread.start()
             self.bind(weewx.NEW_LOOP_PACKET, self.new_loop_packet)
 
-        # bind to ARCHIVE if required
+        # bind to ARCHIVE if required. ARCHIVE stats are collected on
+        # demand, being wanted only once per archive interval
         if len(self.archive_stats) > 0:
             self.bind(weewx.NEW_ARCHIVE_RECORD, self.new_archive_record)
 
+    @staticmethod
+    def make_plan(stats):
+        """tuple of (index, obs_type, get_stat, refresh_period, output_unit,
+        output_group, converters) for each _Obs of stats listed"""
+        return tuple((int(obs), obs.name.lower(), algo.get_stat,
+                      algo.refresh_period, algo.output_unit, algo.output_group,
+                      VitalStatsSvc.make_converters(obs))
+                     for obs in stats
+                     for algo in [VitalStatsSvc.STATS[obs]])
+
+    @staticmethod
+    def make_converters(obs):
+        """map each standard unit system to function converting stat's output
+        into it, or None if already in its unit"""
+        obs_type = obs.name.lower()
+        output_unit = VitalStatsSvc.STATS[obs].output_unit
+        converters = dict()
+        for us_units in (weewx.US, weewx.METRIC, weewx.METRICWX):
+            target_unit = weewx.units.getStandardUnitType(us_units, obs_type)[0]
+            if target_unit is None or target_unit == output_unit:
+                converters[us_units] = None
+            else:
+                converters[us_units] = \
+                    weewx.units.conversionDict[output_unit][target_unit]
+        return converters
+
+    @staticmethod
+    def make_augmenter(plan):
+        """generate function(packet, raw_values) equivalent to augment_packet
+        for plan, but unrolled with each stat's index, obs_type and whether
+        it has conversions built in"""
+
+        namespace = dict()
+        lines = ["def augment(packet, raw_values):",
+                 "    us_units = packet['usUnits']",
+                 "    pkt_values = dict()"]
+        for i, obs_type, _, _, _, _, converters in plan:
+            # stats failing to be collected are None, so left out
+            lines.append(f"    value = raw_values[{i}]")
+            lines.append("    if value is not None:")
+            if any(converters.values()):
+                namespace[f"converters_{i}"] = converters
+                lines.append(f"        convert = converters_{i}[us_units]")
+                lines.append("        if convert is not None:")
+                lines.append("            value = convert(value)")
+            lines.append(f"        pkt_values[{obs_type!r}] = value")
+        lines.append("    packet.update(pkt_values)")
+        exec('\n'.join(lines), namespace)
+        return namespace['augment']
+
     def new_loop_packet(self, event):
         """handle LOOP event by inserting LOOP-related stats"""
-        self.augment_packet(event.packet, self.loop_stats)
+        if weewx.debug > 1:
+            self.augment_packet(event.packet, self._loop_plan, self._latest)
+        else:
+            self._loop_augmenter(event.packet, self._latest)
 
     def new_archive_record(self, event):
         """handle ARCHIVE event by inserting ARCHIVE-related stats"""
-        self.augment_packet(event.record, self.archive_stats)
-
-    def augment_packet(self, packet, stats):
-        """evaluate and insert values of stats listed"""
-
-        for obs_type in stats:
-        
-            # no input to marshall
-
-            # call algorithm
-            raw_value = VitalStatsSvc.STATS[obs_type].get_stat()
-
-            # de-marshall into output ValueTuple
-            output_vt = ValueTuple(raw_value,
-                                   VitalStatsSvc.STATS[obs_type].output_unit,
-                                   VitalStatsSvc.STATS[obs_type].output_group)
-            if weewx.debug > 2:
-                log.debug(f"{self.__class__.__name__}.augment_packet"
-                          f" {obs_type} output_vt={output_vt}")
-
-            # convert output ValueTuple to packet's unit system
-            pkt_vt = weewx.units.convertStd(output_vt, packet['usUnits'])
-            if weewx.debug > 1:
-                log.debug(f"{self.__class__.__name__}.augment_packet"
-                          f" {obs_type}={pkt_vt[0]}")
-
-            # insert into packet
-            if pkt_vt[0] is not None:
-                packet[obs_type] = pkt_vt[0]
+        raw_values = self.collect(self._archive_plan)
+        if weewx.debug > 1:
+            self.augment_packet(event.record, self._archive_plan, raw_values)
+        else:
+            self._archive_augmenter(event.record, raw_values)
+
+    def collect(self, plan):
+        """evaluate stats planned together, returning list of raw values
+        indexed by _Obs (None if not planned or failed)"""
+
+        # no input to marshall, so call each algorithm in a single pass
+        # ahead of any unit conversion. a failing stat is left out rather
+        # than holding back the others, and its error logged only when it
+        # first occurs or changes
+        raw_values = [None]*len(_Obs)
+        for i, obs_type, get_stat, refresh_period, _, _, _ in plan:
+            try:
+                raw_values[i] = _collector.get(i, get_stat, refresh_period)
+            except Exception as e:
+                error = repr(e)
+                if self._failures.get(i) != error:
+                    log.error("%s %s failed: %s", self._cn, obs_type, error)
+                    self._failures[i] = error
+            else:
+                if self._failures.pop(i, None) is not None:
+                    log.info("%s %s recovered", self._cn, obs_type)
+        return raw_values
+
+    def poll_loop(self):
+        """collect LOOP stats every POLL_PERIOD until shutdown"""
+
+        deadline = time.monotonic()
+        while True:
+            # fixed cadence on monotonic deadlines, skipping any missed
+            deadline = max(deadline + VitalStatsSvc.POLL_PERIOD,
+                           time.monotonic())
+            if self._stop_event.wait(deadline - time.monotonic()):
+                break
+            self._latest = self.collect(self._loop_plan)
+
+    def augment_packet(self, packet, plan, raw_values):
+        """insert values of stats planned, from raw values as collected"""
+
+        us_units = packet['usUnits']
+        debug = weewx.debug
+        pkt_values = dict()
+        for i, obs_type, _, _, output_unit, output_group, converters in plan:
+            raw_value = raw_values[i]
+            if raw_value is None:
+                continue
+            if debug > 2:
+                log.debug("%s.augment_packet %s output_vt=%s",
+                          self._cn, obs_type,
+                          ValueTuple(raw_value, output_unit, output_group))
+
+            # convert output to packet's unit system, unless already there
+            convert = converters[us_units]
+            pkt_value = raw_value if convert is None else convert(raw_value)
+            if debug > 1:
+                log.debug("%s.augment_packet %s=%s",
+                          self._cn, obs_type, pkt_value)
+
+            if pkt_value is not None:
+                pkt_values[obs_type] = pkt_value
+
+        # insert into packet all at once
+        packet.update(pkt_values)
 
     def shutDown(self):
-        """respond to shutdown request by setting stat lists to empty"""
+        """respond to shutdown request by stopping poller and setting stat
+        lists to empty"""
 
         if weewx.debug > 0:
-            log.debug(f"{self.__class__.__name__} shutdown")
-        self.loop_stats = self.archive_stats =[]
+            log.debug("%s shutdown", self._cn)
+        self.loop_stats = self.archive_stats = ()
+        self._loop_plan = self._archive_plan = ()
+        self._loop_augmenter = self._archive_augmenter = \
+            self.make_augmenter(())
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=2.0)
+            if self._thread.is_alive():
+                log.warning("%s poller did not stop", self._cn)
+            self._thread = None
+        _collector.clear()